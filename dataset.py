@@ -1,7 +1,8 @@
 from PIL import Image, ImageDraw, ImageFont
 import numpy as np
 from torchvision import transforms
-from torch.utils.data import random_split
+from torch.utils.data import random_split, ConcatDataset, DataLoader, RandomSampler
+from torch.utils.data.distributed import DistributedSampler
 import torch
 import random
 from tqdm import tqdm
@@ -117,40 +118,94 @@ class FontDataset:
         length, # 손글씨 데이터셋의 개수 (int)
     ):
         self.style_font_label = style_font_label
-        self.style_letters = torch.zeros((length, 1, 128, 128)).type(torch.float16)
-        self.content_letters = torch.zeros((length, 1, 128, 128)).type(torch.float16)
+
+        # 이미지는 uint8로 저장하고, GPU로 옮긴 뒤에 float32로 변환한다. (GPU로 복사하는 데이터의 크기를 줄이기 위함)
+        self.style_letters = torch.zeros((length, 1, 128, 128), dtype=torch.uint8)
+        self.content_letters = torch.zeros((length, 1, 128, 128), dtype=torch.uint8)
 
         for i in range(length):
             random_letter = get_random_letter()
-            self.style_letters[i] = style_font.text2img(random_letter, tensor=True)
-            self.content_letters[i] = content_font.text2img(random_letter, tensor=True)
+            self.style_letters[i] = transforms.PILToTensor()(style_font.text2img(random_letter))
+            self.content_letters[i] = transforms.PILToTensor()(content_font.text2img(random_letter))
 
 
     def __len__(self):
         return len(self.style_letters)
 
 
+    def __getitem__(self, idx):
+        style_label = torch.tensor([self.style_font_label], dtype=torch.float16)
+
+        return (self.content_letters[idx], self.style_letters[idx], style_label)
+
+
 
 class FontDataLoader:
 
     def __init__(
         self,
         font_dataset_list, 
-        batch_size
+        batch_size,
+        pin_memory=False, # 배치를 pinned memory에 올려 비동기로 GPU에 복사할 수 있도록 할지 여부
+        rank=0, # 분산 학습에서 현재 프로세스의 순위
+        world_size=1, # 분산 학습에 참여하는 프로세스의 개수
+        num_workers=4 # 배치를 만드는 worker 프로세스의 개수
     ):
         self.font_dataset_list = font_dataset_list
         self.batch_size = batch_size
+        self.pin_memory = pin_memory
+
+        # 이전에 float16으로 저장된 데이터셋이라면 uint8로 변환한다.
+        for font_dataset in self.font_dataset_list:
+            if font_dataset.style_letters.dtype != torch.uint8:
+                font_dataset.style_letters = (font_dataset.style_letters.float() * 255).round().type(torch.uint8)
+                font_dataset.content_letters = (font_dataset.content_letters.float() * 255).round().type(torch.uint8)
+
+        dataset = ConcatDataset(self.font_dataset_list)
+
+        # 분산 학습이라면 각 프로세스가 겹치지 않는 샘플을 나누어 학습한다.
+        if world_size > 1:
+            self.sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=True)
+        else:
+            self.sampler = RandomSampler(dataset)
+
+        # worker 프로세스들이 미리 배치를 만들어 두도록 한다.
+        # (persistent_workers는 epoch마다 worker를 새로 만들지 않도록 하고, drop_last는 배치 크기를 고정한다.)
+        worker_kwargs = {"persistent_workers": True, "prefetch_factor": 4} if num_workers > 0 else {}
+
+        self.dataloader = DataLoader(
+            dataset,
+            batch_size=batch_size,
+            sampler=self.sampler,
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+            drop_last=True,
+            **worker_kwargs
+        )
+
+        self.epoch = 0
 
     
     def __len__(self):
-        return len(self.font_dataset_list) * len(self.font_dataset_list[0]) // self.batch_size
+        return len(self.dataloader)
+
 
+    def __iter__(self):
+        # DistributedSampler는 epoch마다 다른 순서로 섞이도록 epoch을 알려주어야 한다.
+        if isinstance(self.sampler, DistributedSampler):
+            self.sampler.set_epoch(self.epoch)
 
+        self.epoch += 1
+
+        return iter(self.dataloader)
+
+
+    # 테스트 이미지처럼 임의의 배치 하나가 필요할 때 사용한다.
     def get(self, batch_size=None):
         batch_size = self.batch_size if batch_size == None else batch_size
 
-        content_letters = torch.zeros((batch_size, 1, 128, 128)).type(torch.float16)
-        style_letters = torch.zeros((batch_size, 1, 128, 128)).type(torch.float16)
+        content_letters = torch.zeros((batch_size, 1, 128, 128), dtype=torch.uint8)
+        style_letters = torch.zeros((batch_size, 1, 128, 128), dtype=torch.uint8)
         style_labels = torch.zeros((batch_size, 1)).type(torch.float16)
 
         for i in range(batch_size):
@@ -163,6 +218,11 @@ class FontDataLoader:
             style_letters[i] = random_font_dataset.style_letters[random_sample_idx]
             style_labels[i] = random_font_dataset.style_font_label
 
+        if self.pin_memory:
+            content_letters = content_letters.pin_memory()
+            style_letters = style_letters.pin_memory()
+            style_labels = style_labels.pin_memory()
+
         return (content_letters, style_letters, style_labels)
 
 
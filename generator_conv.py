@@ -5,6 +5,7 @@ import torch.nn.functional as F
 from torch.utils.data import TensorDataset, random_split, DataLoader
 from torchsummary import summary
 from torchvision import transforms
+from torch.utils.checkpoint import checkpoint
 
 from PIL import Image
 
@@ -204,12 +205,49 @@ class Generator(nn.Module):
             )
         ])
 
+        # if True, recompute block activations in backward instead of storing them (training only)
+        self.use_checkpointing = False
+
+
+    # gradient checkpointing
+    # BatchNorm layers run outside the checkpointed segments,
+    # so recompute in backward doesn't update their running stats a second time
+    def run_block(self, block, x):
+        if not (self.use_checkpointing and self.training):
+            return block(x)
+
+        segment = []
+
+        for layer in block:
+            if isinstance(layer, nn.BatchNorm2d):
+                x = self.run_segment(segment, x)
+                x = layer(x)
+                segment = []
+
+            else:
+                segment.append(layer)
+
+        return self.run_segment(segment, x)
+
+
+    def run_segment(self, layers, x):
+        if len(layers) == 0:
+            return x
+
+        def segment_forward(x):
+            for layer in layers:
+                x = layer(x)
+
+            return x
+
+        return checkpoint(segment_forward, x, use_reentrant=False)
+
 
     def forward(self, content_letters, style_labels):
         self.content_list = [content_letters]
 
         for i in range(len(self.content_extractor)):
-            self.content_list.append(self.content_extractor[i](self.content_list[-1]))
+            self.content_list.append(self.run_block(self.content_extractor[i], self.content_list[-1]))
         
         self.style = self.style_extractor(style_labels)
 
@@ -219,7 +257,7 @@ class Generator(nn.Module):
         out = latent_vector
 
         for i in range(len(self.generator)):
-            out = self.generator[i](out)
+            out = self.run_block(self.generator[i], out)
 
             if i < 3:
                 out += F.interpolate(self.content_list[-i-1], scale_factor=2.0)
@@ -27,9 +27,9 @@ def show_pred(device, generator, dataloader, n=10):
 
     content_letters, style_letters, style_labels = dataloader.get(batch_size=n)
 
-    content_letters = content_letters.to(device).type(torch.float32)
-    style_letters = style_letters.to(device).type(torch.float32)
-    style_labels = style_labels.to(device).type(torch.float32)
+    content_letters = content_letters.to(device).float().div_(255.0)
+    style_letters = style_letters.to(device).float().div_(255.0)
+    style_labels = style_labels.to(device).float()
 
     content_images = (content_letters.cpu().detach().numpy() * 255).astype(np.uint)
     style_images = (style_letters.cpu().detach().numpy() * 255).astype(np.uint)
@@ -1,20 +1,95 @@
 import torch
 import torch.nn as nn
-from torchvision import transforms
-from torchvision.utils import make_grid
 from torch.utils.data import DataLoader, TensorDataset, random_split
 from torch.optim import Adam
 import torch.nn.functional as F
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+from PIL import Image
 
 import wandb
 
 import pickle
 
+import json
+
+import os
+
+import zipfile
+
+from contextlib import nullcontext
+
 from argparse import ArgumentParser
 
 from models import VGGLoss
 
 
+# 현재 배치를 학습하는 동안 로더에서 다음 배치를 미리 가져와서 별도의 CUDA stream으로 GPU에 복사하는 클래스.
+class CUDAPrefetcher:
+
+    def __init__(self, loader, device, memory_format=torch.contiguous_format):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.memory_format = memory_format
+
+        # GPU가 아니라면 stream 없이 바로 복사한다.
+        self.stream = torch.cuda.Stream(device=self.device) if self.device.type == "cuda" else None
+
+        self.next_batch = None
+
+
+    def __len__(self):
+        return len(self.loader)
+
+
+    # 로더의 배치를 GPU로 옮긴다. uint8 이미지는 GPU에서 float32(memory_format 형식)로 변환하고 [0, 1] 범위로 나눈다.
+    @staticmethod
+    def transfer(batch, device, non_blocking=False, memory_format=torch.contiguous_format):
+        content_letters, style_letters, style_labels = batch
+
+        content_letters = content_letters.to(device, non_blocking=non_blocking).to(torch.float32, memory_format=memory_format).div_(255.0)
+        style_letters = style_letters.to(device, non_blocking=non_blocking).to(torch.float32, memory_format=memory_format).div_(255.0)
+        style_labels = style_labels.to(device, non_blocking=non_blocking).float()
+
+        return (content_letters, style_letters, style_labels)
+
+
+    def preload(self):
+        batch = next(self.loader_iter)
+
+        if self.stream is None:
+            self.next_batch = self.transfer(batch, self.device, memory_format=self.memory_format)
+            return
+
+        with torch.cuda.stream(self.stream):
+            self.next_batch = self.transfer(batch, self.device, non_blocking=True, memory_format=self.memory_format)
+
+
+    def __iter__(self):
+        self.loader_iter = iter(self.loader)
+        self.preload()
+
+        for i in range(len(self)):
+
+            if self.stream is not None:
+                # 복사가 끝날 때까지 현재 stream이 기다리도록 한다.
+                torch.cuda.current_stream(self.device).wait_stream(self.stream)
+
+                # side stream에서 할당한 텐서를 현재 stream에서 사용하므로 메모리가 먼저 해제되지 않도록 기록한다.
+                for t in self.next_batch:
+                    t.record_stream(torch.cuda.current_stream(self.device))
+
+            batch = self.next_batch
+
+            yield batch
+
+            # 현재 배치의 연산이 GPU에 올라간 뒤에 다음 배치를 가져온다.
+            if i + 1 < len(self):
+                self.preload()
+
+
+
 class Trainer:
 
     def __init__(
@@ -26,46 +101,202 @@ class Trainer:
                 mse_penalty,
                 lr=0.002, # 학습률
                 could_wandb=False,
+                compile_generator=True, # torch.compile 사용 여부
+                use_amp=True, # mixed precision 학습 여부 (GPU에서만 사용)
+                rank=0, # 분산 학습에서 현재 프로세스의 순위
+                world_size=1, # 분산 학습에 참여하는 프로세스(GPU)의 개수
+                accum_steps=1, # gradient를 몇 step 동안 모은 뒤 파라미터를 업데이트할지
+                use_checkpointing=False, # gradient checkpointing 사용 여부 (생성 모델이 지원하는 경우)
+                max_grad_norm=None, # gradient clipping의 최대 norm (None이라면 clipping 하지 않음)
             ):
 
-        self.device = device
+        self.device = torch.device(device)
+
+        self.rank = rank
+        self.world_size = world_size
+
+        # 로그, 체크포인트 저장, 예측 이미지 생성은 rank 0 프로세스에서만 한다.
+        self.is_main = rank == 0
+
+        # 배치 크기가 고정되어 있으므로 cuDNN이 가장 빠른 conv 알고리즘을 한 번 찾아서 재사용하도록 하고,
+        # Ampere 이상의 GPU에서는 TF32 연산을 허용한다.
+        if self.device.type == "cuda":
+            torch.backends.cudnn.benchmark = True
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
 
-        self.generator = generator.to(self.device)
+        # GPU에서는 cuDNN의 Tensor Core conv 커널이 NHWC 형식에 맞춰져 있으므로 channels_last 형식을 사용한다.
+        self.memory_format = torch.channels_last if self.device.type == "cuda" else torch.contiguous_format
+
+        self.generator = generator.to(self.device, memory_format=self.memory_format)
+
+        # 생성 모델이 gradient checkpointing을 지원한다면 블록마다 activation을 다시 계산하여 메모리를 아낀다.
+        if use_checkpointing:
+            if hasattr(self.generator, "use_checkpointing"):
+                self.generator.use_checkpointing = True
+
+            else:
+                print(f"{type(self.generator).__name__} does not support gradient checkpointing, train without it")
+
+        # 여러 GPU로 학습한다면 DDP로 감싸서 backward 도중에 gradient를 all-reduce 한다.
+        # (프로세스 그룹은 미리 초기화되어 있어야 한다.)
+        self.ddp_generator = None
+
+        if self.world_size > 1:
+            self.generator = DDP(self.generator, device_ids=[self.device.index])
+            self.ddp_generator = self.generator
+
+        # 작은 생성 모델은 커널 실행 오버헤드가 크므로 torch.compile로 연산을 합치고 CUDA graph를 재사용한다.
+        # 배치 크기가 고정되어 있으므로 dynamic=False로 재컴파일을 막는다.
+        # 예측 이미지를 만드는 모델(infer_generator)은 매 epoch 같은 입력을 받으므로 따로 컴파일하여 CUDA graph를 재사용한다.
+        # (분산 학습에서는 rank 0에서만 호출되므로 DDP의 통신이 일어나지 않도록 원본 모델을 사용한다.)
+        self.infer_generator = self.get_generator_module()
+
+        if compile_generator:
+            try:
+                torch._dynamo.config.cache_size_limit = 8192
+
+                self.generator = torch.compile(self.generator, mode="reduce-overhead", dynamic=False)
+                self.infer_generator = torch.compile(self.get_generator_module(), mode="reduce-overhead", dynamic=False)
+
+            # torch.compile을 지원하지 않는 환경이라면 eager 모드로 학습한다.
+            except Exception as e:
+                print(f"torch.compile is not available, fallback to eager mode: {e}")
+
+        # torch.compile은 첫 forward에서 컴파일하므로, 모델(train/eval 모드)마다 첫 forward가 성공했는지 기록한다. (run_generator 참고)
+        self.checked_generators = set()
 
         self.mse_criterion = F.mse_loss
 
-        self.gen_optim = Adam(self.generator.parameters(), lr=lr, betas=(0.5, 0.999))
+        # GPU에서는 모든 파라미터를 하나의 커널로 업데이트하는 fused Adam을 사용하고,
+        # CPU이거나 fused를 지원하지 않는 버전이라면 foreach 구현을 사용한다.
+        if self.device.type == "cuda":
+            try:
+                self.gen_optim = Adam(self.generator.parameters(), lr=lr, betas=(0.5, 0.999), fused=True)
+
+            # fused 인자가 없는 이전 버전의 PyTorch
+            except TypeError:
+                self.gen_optim = Adam(self.generator.parameters(), lr=lr, betas=(0.5, 0.999), foreach=True)
+
+        else:
+            self.gen_optim = Adam(self.generator.parameters(), lr=lr, betas=(0.5, 0.999), foreach=True)
+
+        # BF16을 지원하는 GPU라면 loss scaling 없이 BF16을, 아니라면 FP16과 GradScaler를 사용한다.
+        self.use_amp = use_amp and self.device.type == "cuda"
+        self.amp_dtype = torch.bfloat16 if self.use_amp and torch.cuda.is_bf16_supported() else torch.float16
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.use_amp and self.amp_dtype == torch.float16)
 
         self.trainloader = trainloader
         self.validloader = validloader
 
         self.mse_penalty = mse_penalty
+        self.loss_scales = {}
+
+        self.accum_steps = accum_steps
+
+        self.max_grad_norm = max_grad_norm
         
         self.best_loss = 1e5
-        self.best_params = None
+        # best 파라미터는 메모리에 들고 있지 않고 loss가 개선될 때만 파일로 저장한다. (run에서 경로를 정한다.)
+        self.best_path = None
 
-        self.test_content_letters, self.test_style_letters, self.test_style_labels = self.validloader.get(batch_size=25)
+        # load_trainer로 이전 학습을 이어서 하는지 여부. (아니라면 run에서 이전 로그를 지우고 새로 기록한다.)
+        self.resume = False
 
-        self.test_content_letters = self.test_content_letters.to(self.device).type(torch.float32)
-        self.test_style_letters = self.test_style_letters.to(self.device).type(torch.float32)
-        self.test_style_labels = self.test_style_labels.to(self.device).type(torch.float32)
+        self.test_content_letters, self.test_style_letters, self.test_style_labels = CUDAPrefetcher.transfer(self.validloader.get(batch_size=25), self.device, memory_format=self.memory_format)
 
         self.train_loss = []
 
         self.valid_loss = []
 
-        self.test_images = []
+        self.could_wandb = could_wandb and self.is_main
+
+
+    # mse_penalty, 평균을 위한 나눗셈, gradient accumulation을 위한 나눗셈을 합친 상수를 반환한다.
+    # (학습과 검증의 배치 크기가 다르므로 원소 개수별로 저장한다.)
+    def get_loss_scale(self, target, accum_steps=1):
+        key = (target.numel(), accum_steps)
+
+        if key not in self.loss_scales:
+            self.loss_scales[key] = self.mse_penalty / float(target.numel() * accum_steps)
+
+        return self.loss_scales[key]
+
+
+    # epoch의 평균 loss와 step별 loss의 분포를 wandb.log 한 번으로 기록한다.
+    # (step별 loss 전체는 로그 파일(<trainer>_loss.jsonl)에 남는다.)
+    def log_losses(self, name, losses, avg_loss):
+        wandb.log({name: avg_loss, f"{name}_steps": wandb.Histogram(losses)})
+
+
+    # torch.compile이나 DDP로 감싼 모델이라면 원본 모델을 반환한다. (state_dict의 키에 "_orig_mod.", "module." 접두사가 붙지 않도록)
+    def get_generator_module(self):
+        generator = getattr(self.generator, "_orig_mod", self.generator)
+
+        if isinstance(generator, DDP):
+            generator = generator.module
+
+        return generator
+
+
+    # self.generator나 self.infer_generator(name)로 forward 한다.
+    # 컴파일된 모델의 첫 forward에서 backend(Triton 등) 에러가 나면 그 모델만 eager 모드로 바꾸어 다시 실행한다.
+    def run_generator(self, name, *inputs):
+        generator = getattr(self, name)
+        key = (name, generator.training)
+
+        if key in self.checked_generators:
+            return generator(*inputs)
+
+        try:
+            out = generator(*inputs)
+
+        except Exception as e:
+            # 컴파일되지 않은 모델에서 난 에러는 그대로 올린다.
+            if not hasattr(generator, "_orig_mod"):
+                raise
+
+            print(f"torch.compile is not available, fallback to eager mode: {e}")
+
+            generator = generator._orig_mod
+            setattr(self, name, generator)
 
-        self.could_wandb = could_wandb
+            out = generator(*inputs)
 
+        self.checked_generators.add(key)
 
-    @torch.no_grad()
+        return out
+
+
+    # 분산 학습이라면 모든 프로세스의 평균 loss를 구한다.
+    def reduce_loss(self, loss):
+        if self.world_size > 1:
+            dist.all_reduce(loss, op=dist.ReduceOp.SUM)
+            loss /= self.world_size
+
+        return loss
+
+
+    @torch.inference_mode()
     def get_pred_image(self):
-        self.generator.eval()
+        self.infer_generator.eval()
+
+        with torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.use_amp):
+            pred = self.run_generator("infer_generator", self.test_content_letters, self.test_style_labels)
+
+        # 정규화와 격자 배치를 GPU에서 한 뒤에 uint8 격자 이미지 하나만 CPU로 복사한다.
+        pred = pred.float()
+        pred = (pred - pred.amin()) / (pred.amax() - pred.amin() + 1e-8)
 
-        pred = self.generator(self.test_content_letters, self.test_style_labels)
-        grid = make_grid(pred.detach().cpu(), nrow=5, normalize=True)
-        image = transforms.ToPILImage()(grid)
+        # (25, C, H, W) -> (C, 5*H, 5*W)
+        n, c, h, w = pred.shape
+        nrow = 5
+        grid = pred.view(n // nrow, nrow, c, h, w).permute(2, 0, 3, 1, 4).reshape(c, n // nrow * h, nrow * w)
+
+        grid = grid.mul(255).clamp(0, 255).to(torch.uint8).cpu().numpy()
+
+        # 흑백 이미지이므로 채널 차원을 제거한다.
+        image = Image.fromarray(grid[0])
         
         return image
 
@@ -74,133 +305,265 @@ class Trainer:
 
         self.generator.train()
 
-        avg_loss = 0
+        # loss.item()을 매 step 호출하면 GPU와 동기화가 일어나므로 loss를 GPU에 모아두었다가 epoch 마지막에 한 번만 가져온다.
+        losses = []
 
-        for _ in range(len(self.trainloader)):
+        # 각 step이 속한 accumulation 그룹의 크기. (step 수가 accum_steps로 나누어 떨어지지 않으면 마지막 그룹은 더 작다.)
+        accum_sizes = []
 
-            content_letters, style_letters, style_labels = self.trainloader.get()
-            content_letters = content_letters.to(self.device).type(torch.float32)
-            style_letters = style_letters.to(self.device).type(torch.float32)
-            style_labels = style_labels.to(self.device).type(torch.float32)
+        for i, (content_letters, style_letters, style_labels) in enumerate(CUDAPrefetcher(self.trainloader, self.device, self.memory_format)):
 
-            generated_image = self.generator(content_letters, style_labels)
+            # accum_steps마다 (그리고 epoch의 마지막 step에서) 파라미터를 업데이트한다.
+            is_update_step = (i + 1) % self.accum_steps == 0 or (i + 1) == len(self.trainloader)
 
-            loss = self.mse_criterion(generated_image, style_letters)
+            # 마지막 그룹은 실제 step 수로 나누어 gradient가 작아지지 않도록 한다.
+            accum_size = min(self.accum_steps, len(self.trainloader) - (i - i % self.accum_steps))
+            accum_sizes.append(accum_size)
 
-            loss = self.mse_penalty * loss
+            # DDP라면 파라미터를 업데이트하지 않는 step에서는 gradient all-reduce를 생략한다.
+            sync_context = self.ddp_generator.no_sync() if self.ddp_generator is not None and not is_update_step else nullcontext()
 
-            avg_loss += loss.item()
+            with sync_context:
+                with torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.use_amp):
+                    generated_image = self.run_generator("generator", content_letters, style_labels)
 
-            self.gen_optim.zero_grad()
-            loss.backward()
-            self.gen_optim.step()
+                # loss는 FP32로 계산한다.
+                # 평균을 구한 뒤 mse_penalty를 곱하지 않고, 합에 두 상수를 합친 값을 한 번만 곱한다.
+                # accumulation 그룹의 크기로 나누는 것도 같은 상수에 포함시켜서 step마다 곱셈 하나만 실행되도록 한다.
+                loss = self.mse_criterion(generated_image.float(), style_letters, reduction="sum") * self.get_loss_scale(style_letters, accum_size)
 
-            if self.could_wandb:
-                wandb.log({"train_loss": loss.item()})
+                self.scaler.scale(loss).backward()
+
+            losses.append(loss.detach())
+
+            if is_update_step:
+                # gradient clipping은 scale을 되돌린 gradient에 대해 모든 파라미터를 한 번에(foreach) 처리한다.
+                if self.max_grad_norm is not None:
+                    self.scaler.unscale_(self.gen_optim)
+                    torch.nn.utils.clip_grad_norm_(self.generator.parameters(), self.max_grad_norm, foreach=True)
+
+                self.scaler.step(self.gen_optim)
+                self.scaler.update()
+                self.gen_optim.zero_grad(set_to_none=True)
+
+        # accumulation 그룹의 크기로 나눈 loss를 epoch 마지막에 한 번에 원래 크기로 되돌린다.
+        losses = torch.stack(losses) * torch.tensor(accum_sizes, dtype=torch.float32, device=self.device)
+        avg_loss = losses.sum()
+
+        losses = losses.cpu().tolist()
+        self.train_loss.extend(losses)
 
-            self.train_loss.append(loss.item())
+        avg_loss = self.reduce_loss(avg_loss).item() / len(self.trainloader)
 
-        avg_loss /= len(self.trainloader)
+        if self.could_wandb:
+            self.log_losses("train_loss", losses, avg_loss)
 
         return avg_loss
     
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def valid(self):
 
         self.generator.eval()
 
-        avg_loss = 0
+        losses = []
 
-        for _ in range(len(self.validloader)):
+        for content_letters, style_letters, style_labels in CUDAPrefetcher(self.validloader, self.device, self.memory_format):
 
-            content_letters, style_letters, style_labels = self.validloader.get()
-            content_letters = content_letters.to(self.device).type(torch.float32)
-            style_letters = style_letters.to(self.device).type(torch.float32)
-            style_labels = style_labels.to(self.device).type(torch.float32)
+            with torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.use_amp):
+                generated_image = self.run_generator("generator", content_letters, style_labels)
 
-            generated_image = self.generator(content_letters, style_labels)
+            loss = self.mse_criterion(generated_image.float(), style_letters, reduction="sum") * self.get_loss_scale(style_letters)
 
-            loss = self.mse_criterion(generated_image, style_letters)
+            losses.append(loss.detach())
 
-            loss = self.mse_penalty * loss
+        losses = torch.stack(losses)
+        avg_loss = losses.sum()
 
-            avg_loss += loss.item()
+        losses = losses.cpu().tolist()
+        self.valid_loss.extend(losses)
 
-            if self.could_wandb:
-                wandb.log({"valid_loss": loss.item()})
-
-            self.valid_loss.append(loss.item())
+        avg_loss = self.reduce_loss(avg_loss).item() / len(self.validloader)
 
-        avg_loss /= len(self.validloader)
+        if self.could_wandb:
+            self.log_losses("valid_loss", losses, avg_loss)
 
-        if avg_loss <= self.best_loss:
+        # best 파라미터를 저장할 경로가 정해져 있을 때만(run 또는 load_trainer 이후, rank 0) best_loss를 갱신한다.
+        # (저장하지 못한 파라미터의 loss로 best_loss가 낮아지지 않도록)
+        if self.best_path is not None and avg_loss <= self.best_loss:
             self.best_loss = avg_loss
-            self.best_params = self.generator.state_dict()
+
+            best_params = {k: v.detach().cpu() for k, v in self.get_generator_module().state_dict().items()}
+            torch.save(best_params, self.best_path)
 
         return avg_loss
 
 
+    # trainer 파일 경로로부터 loss 로그 파일, 예측 이미지 폴더, best 파라미터 파일의 경로를 구한다.
+    @staticmethod
+    def get_log_paths(trainer_path):
+        base_path = os.path.splitext(trainer_path)[0]
+
+        return (f"{base_path}_loss.jsonl", f"{base_path}_images", f"{base_path}_best.pt")
+
+
+    # pickle.dump로 저장하던 이전 형식의 trainer 파일을 읽어서 새 형식으로 바꾼다.
+    # loss 기록은 로그 파일로, 예측 이미지는 이미지 폴더로, best 파라미터는 best 파라미터 파일로 옮긴다. (rank 0에서만)
+    # (이전 형식은 epoch 구분이 없으므로 loss 기록 전체를 한 줄로 저장한다.)
+    def load_legacy_trainer(self, path):
+        with open(path, "rb") as f:
+            legacy_data = pickle.load(f)
+
+        loss_path, image_dir, best_path = self.get_log_paths(path)
+
+        if self.is_main:
+            with open(loss_path, "w") as f:
+                epoch_log = {
+                    "epoch": None,
+                    "train_loss": list(legacy_data["train_loss"]),
+                    "valid_loss": list(legacy_data["valid_loss"])
+                }
+                f.write(json.dumps(epoch_log) + "\n")
+
+            os.makedirs(image_dir, exist_ok=True)
+
+            for epoch, image in enumerate(legacy_data.get("test_images", [])):
+                image.save(os.path.join(image_dir, f"img_{epoch:04d}.png"))
+
+            if legacy_data.get("best_params") is not None:
+                best_params = {k: v.detach().cpu() for k, v in legacy_data["best_params"].items()}
+                torch.save(best_params, best_path)
+
+        trainer_data = {
+            "generator_params": legacy_data["generator_params"],
+            "best_loss": legacy_data["best_loss"],
+            "test_content_letters": legacy_data["test_content_letters"].to(self.device, memory_format=self.memory_format),
+            "test_style_letters": legacy_data["test_style_letters"].to(self.device, memory_format=self.memory_format),
+            "test_style_labels": legacy_data["test_style_labels"].to(self.device),
+        }
+
+        return trainer_data
+
+
     def load_trainer(self, path, wandb_log=True):
-        with open(path, 'rb') as f:
-            trainer_data = pickle.load(f)
+        # torch.save로 저장한 파일은 zip 형식이고, 그렇지 않다면 이전 형식(pickle)의 파일이다.
+        if zipfile.is_zipfile(path):
+            trainer_data = torch.load(path, map_location=self.device)
+
+        else:
+            trainer_data = self.load_legacy_trainer(path)
 
-        self.generator.load_state_dict(trainer_data["generator_params"])
+        self.get_generator_module().load_state_dict(trainer_data["generator_params"])
         self.best_loss = trainer_data["best_loss"]
-        self.best_params = trainer_data["best_params"]
         self.test_content_letters = trainer_data["test_content_letters"]
         self.test_style_letters = trainer_data["test_style_letters"]
         self.test_style_labels = trainer_data["test_style_labels"]
-        self.test_images = trainer_data["test_images"]
-        self.train_loss = trainer_data["train_loss"]
-        self.valid_loss = trainer_data["valid_loss"]
+
+        loss_path, image_dir, best_path = self.get_log_paths(path)
+
+        # best 파라미터 파일은 rank 0에서만 저장한다.
+        if self.is_main:
+            self.best_path = best_path
+
+        # epoch마다 한 줄씩 추가된 loss 로그를 읽어온다.
+        self.train_loss = []
+        self.valid_loss = []
+
+        if os.path.exists(loss_path):
+            with open(loss_path, "r") as f:
+                for line in f:
+                    epoch_log = json.loads(line)
+                    self.train_loss.extend(epoch_log["train_loss"])
+                    self.valid_loss.extend(epoch_log["valid_loss"])
 
         if wandb_log and self.could_wandb:
             wandb.config.update({"best_loss": self.best_loss})
 
-            for loss in self.train_loss:
-                wandb.log({"train_loss": loss})
+            # 이전 학습의 loss 기록은 하나씩 기록하지 않고 테이블로 한 번에 올린다.
+            train_table = wandb.Table(data=[[i, loss] for i, loss in enumerate(self.train_loss)], columns=["train_step", "train_loss"])
+            valid_table = wandb.Table(data=[[i, loss] for i, loss in enumerate(self.valid_loss)], columns=["valid_step", "valid_loss"])
 
-            for loss in self.valid_loss:
-                wandb.log({"valid_loss": loss})
+            wandb.log({
+                "train_loss_history": wandb.plot.line(train_table, "train_step", "train_loss", title="train_loss_history"),
+                "valid_loss_history": wandb.plot.line(valid_table, "valid_step", "valid_loss", title="valid_loss_history")
+            })
 
-            for i, img in enumerate(self.test_images):
-                wandb.log({"pred_image": wandb.Image(img)})
+            # 예측 이미지는 메모리에 들고 있지 않으므로 저장된 파일에서 하나씩 읽어서 기록한다.
+            if os.path.isdir(image_dir):
+                for image_file in sorted(os.listdir(image_dir)):
+                    if image_file.endswith(".png"):
+                        wandb.log({"pred_image": wandb.Image(os.path.join(image_dir, image_file))})
+
+        self.resume = True
 
 
     def run(self, epochs: tuple, trainer_path: str):
         
+        loss_path, image_dir, best_path = self.get_log_paths(trainer_path)
+
+        # 파일은 rank 0에서만 저장한다.
+        if self.is_main:
+            self.best_path = best_path
+            os.makedirs(image_dir, exist_ok=True)
+
+            # 처음부터 학습한다면 같은 경로에 남아있는 이전 학습의 loss 로그와 예측 이미지를 지운다.
+            if not self.resume:
+                open(loss_path, "w").close()
+
+                for image_file in os.listdir(image_dir):
+                    if image_file.startswith("img_") and image_file.endswith(".png"):
+                        os.remove(os.path.join(image_dir, image_file))
+
+            # 같은 trainer로 run을 다시 호출하면 이어서 기록한다.
+            self.resume = True
+
         for epoch in range(*epochs):
 
-            print("-" * 50 + f" EPOCH: [{epoch+1}/{epochs[1]}] " + "-" * 50, end="\n\n")
-            
-            print("TRAIN", end="\n")
+            if self.is_main:
+                print("-" * 50 + f" EPOCH: [{epoch+1}/{epochs[1]}] " + "-" * 50, end="\n\n")
+
+            train_loss_start = len(self.train_loss)
+            valid_loss_start = len(self.valid_loss)
+
             train_loss = self.train()
+            valid_loss = self.valid()
+
+            if not self.is_main:
+                continue
+
+            print("TRAIN", end="\n")
             print(f"train_loss: {train_loss}", end="\n\n")
 
             print("VALID", end="\n")
-            valid_loss = self.valid()
             print(f"valid_loss: {valid_loss}", end="\n\n")
 
             pred_image = self.get_pred_image()
             if self.could_wandb:
                 wandb.log({"pred_image": wandb.Image(pred_image)})
-            self.test_images.append(pred_image)
 
+            # 예측 이미지는 epoch마다 별도의 파일로 저장한다.
+            image_path = os.path.join(image_dir, f"img_{epoch:04d}.png")
+            pred_image.save(image_path)
+
+            # 체크포인트에는 크기가 변하지 않는 값들만 저장한다.
             trainer_data = {
-                "generator_params": self.generator.state_dict(),
+                "generator_params": self.get_generator_module().state_dict(),
                 "best_loss": self.best_loss,
-                "best_params": self.best_params,
                 "test_content_letters": self.test_content_letters,
                 "test_style_letters": self.test_style_letters,
                 "test_style_labels": self.test_style_labels,
-                "test_images": self.test_images,
-                "train_loss": self.train_loss,
-                "valid_loss": self.valid_loss
             }
 
-            with open(trainer_path, "wb") as f:
-                pickle.dump(trainer_data, f, pickle.HIGHEST_PROTOCOL)
+            torch.save(trainer_data, trainer_path, _use_new_zipfile_serialization=True)
+
+            # 체크포인트가 저장된 뒤에 이번 epoch의 loss만 로그 파일에 추가한다. (체크포인트에 없는 epoch이 로그에 남지 않도록)
+            with open(loss_path, "a") as f:
+                epoch_log = {
+                    "epoch": epoch,
+                    "train_loss": self.train_loss[train_loss_start:],
+                    "valid_loss": self.valid_loss[valid_loss_start:]
+                }
+                f.write(json.dumps(epoch_log) + "\n")
 
             if self.could_wandb:
                 wandb.config.update({"best_loss": self.best_loss})
@@ -223,6 +586,14 @@ if __name__ == '__main__':
 
     parser.add_argument("--valid_batch_size", default=16*2, help="batch size that used while model evaluate (valid)")
 
+    parser.add_argument("--accum_steps", default=1, type=int, help="number of steps that accumulate gradients before an optimizer step")
+
+    parser.add_argument("--use_checkpointing", action="store_true", help="recompute activations of generator blocks in backward to save memory")
+
+    parser.add_argument("--max_grad_norm", default=None, type=float, help="max norm of gradients (no clipping if not given)")
+
+    parser.add_argument("--num_workers", default=4, type=int, help="number of worker processes that make batches")
+
     parser.add_argument("--mse_penalty", default=5, help="constant that will multiply with mse_loss")
 
     parser.add_argument("--epochs", "-e", default=(0, 10), type=tuple, help="epochs that type is tuple")
@@ -231,6 +602,19 @@ if __name__ == '__main__':
 
     # wandb.config.update(args)
 
+    # torchrun으로 실행했다면 프로세스마다 GPU 하나를 맡아서 분산 학습한다.
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    rank = int(os.environ.get("RANK", 0))
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+
+    if world_size > 1:
+        dist.init_process_group("nccl")
+        torch.cuda.set_device(local_rank)
+        device = torch.device("cuda", local_rank)
+
+    else:
+        device = torch.device('cuda' if torch.cuda.is_available() else "cpu")
+
 
     with open("./data/train_dataset_list.pickle", "rb") as f:
         train_dataset_list = pickle.load(f)
@@ -238,10 +622,8 @@ if __name__ == '__main__':
     with open("./data/valid_dataset_list.pickle", "rb") as f:
         valid_dataset_list = pickle.load(f)
 
-    trainloader = FontDataLoader(font_dataset_list=train_dataset_list, batch_size=args.train_batch_size)
-    validloader = FontDataLoader(font_dataset_list=valid_dataset_list, batch_size=args.valid_batch_size)
-
-    device = torch.device('cuda' if torch.cuda.is_available() else "cpu")
+    trainloader = FontDataLoader(font_dataset_list=train_dataset_list, batch_size=args.train_batch_size, pin_memory=device.type == "cuda", rank=rank, world_size=world_size, num_workers=args.num_workers)
+    validloader = FontDataLoader(font_dataset_list=valid_dataset_list, batch_size=args.valid_batch_size, pin_memory=device.type == "cuda", rank=rank, world_size=world_size, num_workers=args.num_workers)
 
     generator = Generator()
 
@@ -252,7 +634,15 @@ if __name__ == '__main__':
         validloader=validloader,
         mse_penalty=args.mse_penalty,
         lr=args.learning_rate,
-        could_wandb=False
+        could_wandb=False,
+        accum_steps=args.accum_steps,
+        use_checkpointing=args.use_checkpointing,
+        max_grad_norm=args.max_grad_norm,
+        rank=rank,
+        world_size=world_size
     )
     
-    trainer.run(epochs=(0, 1), trainer_path="./trainer.pickle")
+    trainer.run(epochs=(0, 1), trainer_path="./trainer.pt")
+
+    if world_size > 1:
+        dist.destroy_process_group()